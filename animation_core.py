@@ -0,0 +1,1726 @@
+import os
+import re
+import json
+
+import threading
+import multiprocessing
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from abc import ABC, abstractmethod
+import tempfile
+
+import glob
+import requests
+
+import moviepy.editor as mp
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from moviepy.config import get_setting
+from moviepy.tools import subprocess_call
+from PIL import Image, ImageDraw, ImageFont
+import wave
+from proglog import ProgressBarLogger
+
+import numpy as np
+import random
+
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+import subprocess
+import ctypes
+import math
+import shutil
+import hashlib
+import bisect
+import copy
+import time
+import traceback
+
+resolution = (1920, 1080)
+default_character_order = None
+fps = 30
+output = "output.mp4"
+
+# 書き出しプロファイル　draft はタイミング確認用（表情タイムライン・立ち絵は final と同じデータを使う）
+# background_proxy: 背景動画のプロキシがあれば使う（final は元ファイルから書き出す）
+render_profiles = {
+    "final": {"resolution": resolution, "fps": fps, "preset": "medium", "output": output, "segment_cache": "cache/segments",
+              "background_proxy": False},
+    "draft": {"resolution": (640, 360), "fps": 15, "preset": "ultrafast", "output": "output_draft.mp4",
+              "segment_cache": "cache/segments/draft", "background_proxy": True},
+}
+
+character_data = {
+    "ずんだもん": {"ノーマル": 3, "あまあま": 1, "ツンツン": 7, "セクシー": 5, "ささやき": 22, "ヒソヒソ": 38, "ヘロヘロ": 75, "なみだめ": 76},
+    "四国めたん": {"ノーマル": 2, "あまあま": 0, "ツンツン": 6, "セクシー": 4, "ささやき": 36, "ヒソヒソ": 37}
+}
+
+character_images = {
+    'ずんだもん': {
+        'normal': "zundamon_normal.png",
+        'open_eye_close_mouth': "zundamon_normal.png",
+        'open_eye_mid_mouth': "zundamon_mouth_mid.png",
+        'open_eye_open_mouth': "zundamon_mouth_open.png",
+        'close_eye_close_mouth': "zundamon_mouth_close_eye_close.png",
+        'close_eye_mid_mouth': "zundamon_mouth_mid_eye_close.png",
+        'close_eye_open_mouth': "zundamon_mouth_open_eye_close.png"
+    },
+    '四国めたん': {
+        'normal': "metan_normal.png",
+        'open_eye_close_mouth': "metan_normal.png",
+        'open_eye_mid_mouth': "metan_mouth_mid.png",
+        'open_eye_open_mouth': "metan_mouth_open.png",
+        'close_eye_close_mouth': "metan_mouth_close_eye_close.png",
+        'close_eye_mid_mouth': "metan_mouth_mid_eye_close.png",
+        'close_eye_open_mouth': "metan_mouth_open_eye_close.png"
+    }
+}
+
+def query_path(wav_path):
+    # WAV と並べて保存する audio_query の JSON（モーラごとの長さ）
+    return os.path.splitext(wav_path)[0] + ".query.json"
+
+class SynthesisCache:
+    # VOICEVOX 合成結果のキャッシュ　(テキスト, 話者, クエリ, エンジンバージョン) のハッシュで保存、容量超過時は LRU で削除
+    # 索引は SQLite なので、一括生成の並列プロセスから同時に読み書きしても壊れない
+    def __init__(self, cache_dir="cache/voice", max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.db")
+        self.conn = None
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, text, speaker_id, params, engine_version):
+        source = json.dumps({"text": text, "speaker": speaker_id, "params": params, "engine": engine_version},
+                            ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def connect(self):
+        # 接続はプロセスごと（ワーカープロセスへ fork された接続は使わない）
+        if self.conn is None or self.pid != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            self.conn, self.pid = conn, os.getpid()
+            self.import_files(conn)
+        return self.conn
+
+    def import_files(self, conn):
+        # 索引が空なら、以前の index.json とディスク上の WAV を取り込む（索引にないファイルも LRU の対象にする）
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            evicted = []
+            if not conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone():
+                old_index = {}
+                json_path = os.path.join(self.cache_dir, "index.json")
+                if os.path.exists(json_path):
+                    with open(json_path, 'r', encoding='utf-8') as f:
+                        old_index = json.load(f)
+                for path in glob.glob(os.path.join(self.cache_dir, "*.wav")):
+                    key = os.path.splitext(os.path.basename(path))[0]
+                    size = sum(os.path.getsize(p) for p in (path, query_path(path)) if os.path.exists(p))
+                    last_access = old_index.get(key, {}).get("last_access", os.path.getmtime(path))
+                    conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?)", (key, size, last_access))
+                evicted = self.evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.remove_files(evicted)
+
+    def write_file(self, path, content):
+        # 一意の一時ファイルから置き換える（別プロセスが同じキーを同時に書いても衝突しない）
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def remove_files(self, keys):
+        for key in keys:
+            path = os.path.join(self.cache_dir, key + ".wav")
+            for path in (path, query_path(path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def fetch(self, key, output_path):
+        path = os.path.join(self.cache_dir, key + ".wav")
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                found = conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)).rowcount
+            try:
+                if not found:
+                    raise FileNotFoundError(path)
+                shutil.copyfile(path, output_path)
+                if os.path.exists(query_path(path)):                # 以前の版のキャッシュにはクエリがない
+                    shutil.copyfile(query_path(path), query_path(output_path))
+            except FileNotFoundError:
+                if found:                                           # 他のプロセスが削除した
+                    with conn:
+                        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def store(self, key, content, query=None):
+        path = os.path.join(self.cache_dir, key + ".wav")
+        with self.lock:
+            conn = self.connect()
+            self.write_file(path, content)
+            if query is not None:
+                self.write_file(query_path(path), query)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                             (key, len(content) + len(query or b""), time.time()))
+                evicted = self.evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self.remove_files(evicted)
+
+    def evict(self, conn):
+        # 古いものから索引を削除し、削除したキーを返す（ファイルはコミット後に消す）
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            evicted.append(key)
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": size,
+            }
+
+voice_cache = SynthesisCache()   # VoiceGenerator 間で共有
+
+class ProjectIndex:
+    # プロジェクトの全行（セリフ・背景）を1つの SQLite ファイルで管理する
+    # 一覧表示用の列は開始時刻・レイヤーで索引し、行の JSON は data 列にそのまま持つ
+    # 空の状態で開いたときは json/ の個別ファイルを取り込む
+    schema = """
+        CREATE TABLE IF NOT EXISTS lines (
+            filename TEXT PRIMARY KEY, character TEXT, speaker_id INTEGER, text TEXT, layer,
+            position TEXT, start_time REAL, duration, volume, data TEXT);
+        CREATE INDEX IF NOT EXISTS lines_start_time ON lines (start_time);
+        CREATE INDEX IF NOT EXISTS lines_layer ON lines (layer, start_time);
+        CREATE TABLE IF NOT EXISTS backgrounds (
+            filename TEXT PRIMARY KEY, background_file TEXT, start_time REAL, duration REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS backgrounds_start_time ON backgrounds (start_time);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, next INTEGER);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, priority INTEGER, status TEXT, params TEXT,
+            checkpoint TEXT, cancel INTEGER DEFAULT 0, error TEXT, created REAL, updated REAL);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id);
+    """
+
+    def __init__(self, path="project.db", json_dir="json"):
+        self.path = path
+        self.json_dir = json_dir
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # 接続はプロセスごと（ワーカープロセスへ fork された接続は使わない）
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.schema)
+            self.conn, self.pid = conn, os.getpid()
+            empty = not conn.execute("SELECT 1 FROM lines UNION ALL SELECT 1 FROM backgrounds LIMIT 1").fetchone()
+            if empty and os.path.isdir(self.json_dir):
+                self.import_json(conn)
+        return self.conn
+
+    def import_json(self, conn=None):
+        # json/ の個別ファイルを1トランザクションで取り込む
+        conn = conn or self.connect()
+        with conn:
+            for filename in sorted(os.listdir(self.json_dir)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(self.json_dir, filename), 'r', encoding='utf-8') as file:
+                        self.write(conn, filename, json.load(file))
+
+    def write(self, conn, filename, data):
+        if "background_" in filename:
+            conn.execute("INSERT OR REPLACE INTO backgrounds VALUES (?, ?, ?, ?, ?)", (
+                filename, data.get("background_file", ""), float(data.get("start_time", 0)),
+                float(data.get("duration", 0)), json.dumps(data, ensure_ascii=False)))
+        else:
+            conn.execute("INSERT OR REPLACE INTO lines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                filename, data["character"], data["speaker_id"], data["text"], data.get("layer", 1),
+                data["position"], float(data.get("start_time", 0)), data.get("duration", ""), data.get("volume"),
+                json.dumps(data, ensure_ascii=False)))
+
+    def put(self, filename, data):
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                self.write(conn, filename, data)
+
+    def get(self, filename):
+        table = "backgrounds" if "background_" in filename else "lines"
+        with self.lock:
+            row = self.connect().execute(f"SELECT data FROM {table} WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            raise KeyError(filename)
+        return json.loads(row[0])
+
+    def update(self, filename, **fields):
+        # 読み出し→書き戻しを1トランザクションで
+        table = "backgrounds" if "background_" in filename else "lines"
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                row = conn.execute(f"SELECT data FROM {table} WHERE filename = ?", (filename,)).fetchone()
+                if row is None:
+                    raise KeyError(filename)
+                data = json.loads(row[0])
+                data.update(fields)
+                self.write(conn, filename, data)
+        return data
+
+    def lines(self):
+        # (キャラクター, 話者ID, セリフ, レイヤー, 横位置, 開始, 長さ, ボリューム, ファイル名)　開始時刻順
+        with self.lock:
+            return self.connect().execute(
+                "SELECT character, speaker_id, text, layer, position, start_time, duration, volume, filename "
+                "FROM lines ORDER BY start_time").fetchall()
+
+    def backgrounds(self):
+        # (開始, 長さ, 背景ファイル, ファイル名)　開始時刻順
+        with self.lock:
+            return self.connect().execute(
+                "SELECT start_time, duration, background_file, filename FROM backgrounds ORDER BY start_time").fetchall()
+
+    def allocate_number(self, prefix="output"):
+        # 出力番号を採番する　BEGIN IMMEDIATE で書き込みロックを取るのでスレッド・プロセス間で重複しない
+        # 削除された番号も再利用しない
+        table = "backgrounds" if prefix == "background" else "lines"
+        with self.lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT next FROM counters WHERE name = ?", (prefix,)).fetchone()
+                if row is None:
+                    # 初回は索引とディスク上の既存ファイルの最大番号の次から
+                    names = [name for (name,) in conn.execute(f"SELECT filename FROM {table}")]
+                    names += [os.path.basename(path) for path in glob.glob(f"video/{prefix}_*.mov")]
+                    numbers = [int(match.group(1)) for name in names
+                               for match in [re.fullmatch(prefix + r"_(\d+)\.(json|mov)", name)] if match]
+                    number = max(numbers, default=0) + 1
+                else:
+                    number = row[0]
+                conn.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (prefix, number + 1))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return number
+
+project_index = ProjectIndex()   # GUI・合成・一括生成で共有
+
+class VoiceGenerator:
+    def __init__(self, base_url="http://localhost:50021", cache=voice_cache, max_connections=4):
+        self.base_url = base_url
+        self.cache = cache
+        self.engine_version = None
+        self.segment_timings = []
+        # keep-alive 接続を使い回す
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_engine_version(self):
+        if self.engine_version is None:
+            try:
+                response = self.session.get(f"{self.base_url}/version")
+                self.engine_version = response.json() if response.status_code == 200 else "unknown"
+            except (requests.RequestException, ValueError):
+                self.engine_version = "unknown"
+        return self.engine_version
+
+    def generate_voice(self, text, speaker_id=1, output_path="temp/output.wav"):
+        print("Generating voice")
+        params = {
+            "text": text,
+            "speaker": speaker_id
+        }
+        if self.cache is not None:
+            key = self.cache.make_key(text, speaker_id, params, self.get_engine_version())
+            if self.cache.fetch(key, output_path):
+                print(f"Voice cache hit: {self.cache.stats()}")
+                return output_path
+
+        query = self.session.post(f"{self.base_url}/audio_query", params=params)   ################################################### 改善個所　VOICE VOX 起動確認
+        if query.status_code != 200:
+            raise Exception(f"VoiceVox API query error: {query.status_code}")
+
+        synthesis = self.session.post(f"{self.base_url}/synthesis", params={"speaker": speaker_id}, data=query.content)
+        if synthesis.status_code != 200:
+            raise Exception(f"VoiceVox API synthesis error: {synthesis.status_code}")
+
+        with open(output_path, "wb") as f:
+            f.write(synthesis.content)
+        with open(query_path(output_path), "wb") as f:       # 口パク（モーラ単位）用に残す
+            f.write(query.content)
+        if self.cache is not None:
+            self.cache.store(key, synthesis.content, query.content)
+
+        return output_path
+
+    def generate_voices(self, jobs, speaker_id=1, max_workers=4):
+        # セグメントを並列に合成　結果は元の順番で返す
+        self.get_engine_version()
+
+        def synthesize(job):
+            text, output_path = job
+            started = time.perf_counter()
+            self.generate_voice(text, speaker_id, output_path)
+            return output_path, time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = list(executor.map(synthesize, jobs))
+
+        self.segment_timings = [(text, elapsed) for (text, _), (_, elapsed) in zip(jobs, results)]
+        for text, elapsed in self.segment_timings:
+            print(f"Synthesized in {elapsed:.2f}s: {text}")
+        return [output_path for output_path, _ in results]
+
+    def get_audio_duration(self, audio_path):
+        with wave.open(audio_path, 'r') as audio_file:
+            frames = audio_file.getnframes()
+            rate = audio_file.getframerate()
+            duration = frames / float(rate)
+        return duration
+
+class ImageProcessor:
+    def __init__(self, resolution=(1920, 1080)):
+        self.resolution = resolution
+
+    def check_alpha_channel(self, image_path):
+        image = Image.open(image_path).convert("RGBA")
+        np_image = np.array(image)
+        alpha_channel = np_image[:, :, 3]
+        unique_alpha_values = np.unique(alpha_channel)
+        print(f"Unique alpha values in the image {image_path}: {unique_alpha_values}")
+
+    def resize_image(self, image_path, height):
+        image = Image.open(image_path).convert("RGBA")
+        return image.resize((int(image.width * (height / image.height)), height))
+
+class SpriteCache:
+    # 立ち絵キャッシュ　(キャラクター, 表情, 解像度) ごとにデコード・リサイズは1回だけ
+    def __init__(self, image_dir="image"):
+        self.image_dir = image_dir
+        self.sprites = {}
+        self.lock = threading.Lock()
+
+    def get(self, character, state, resolution):
+        key = (character, state, tuple(resolution))
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            with self.lock:
+                sprite = self.sprites.get(key)
+                if sprite is None:
+                    sprite = self.load(character_images[character][state], resolution[1])
+                    self.sprites[key] = sprite
+        return sprite
+
+    def load(self, filename, height):
+        img = Image.open(os.path.join(self.image_dir, filename)).convert("RGBA")
+        img_resized = img.resize((int(img.width * (height / img.height)), height), Image.Resampling.LANCZOS)
+        img_resized.load()
+        return img_resized
+
+    def preload(self, character, resolution):
+        return {state: self.get(character, state, resolution) for state in character_images[character]}
+
+    def premultiplied(self, character, state, resolution):
+        # 合成用　不透明部分だけに切り詰めた乗算済みα（位置は立ち絵左上からの相対）
+        key = ("premultiplied", character, state, tuple(resolution))
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            rgba = np.array(self.get(character, state, resolution))
+            sprite = premultiply(rgba[:, :, :3], rgba[:, :, 3] / 255.0)
+            with self.lock:
+                self.sprites[key] = sprite
+        return sprite
+
+    def clear(self):
+        with self.lock:
+            self.sprites.clear()
+
+sprite_cache = SpriteCache()   # Animator 間で共有
+
+# 表情番号 → 立ち絵　口 (閉・中・開) + 3 * 目閉じ
+sprite_states = [
+    'normal', 'open_eye_mid_mouth', 'open_eye_open_mouth',
+    'close_eye_close_mouth', 'close_eye_mid_mouth', 'close_eye_open_mouth'
+]
+mouth_thresholds = (1000, 3000)   # 音量 → 口の開き
+
+# モーラ単位の口パク（audio_query）　母音 → 口の開き、無声化（大文字）・撥音 N・促音 cl・pau は閉じる
+mora_vowel_mouth = {"a": 2, "o": 2, "e": 1, "i": 1, "u": 1}
+closed_consonants = {"m", "my", "b", "by", "p", "py"}   # 唇を閉じる子音
+
+def load_query(wav_path):
+    path = query_path(wav_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def mora_mouth_intervals(query, offset=0.0):
+    # アクセント句のモーラ長から [開始秒, 終了秒, 口] を作る（offset は WAV の先頭位置）
+    phonemes = [(query.get("prePhonemeLength", 0.0), 0)]   # (長さ, 口)
+    pause_scale = query.get("pauseLengthScale", 1.0)
+    for phrase in query.get("accent_phrases", []):
+        for mora in phrase["moras"]:
+            mouth = mora_vowel_mouth.get(mora["vowel"], 0)
+            if mora.get("consonant"):
+                phonemes.append((mora.get("consonant_length") or 0.0, 0 if mora["consonant"] in closed_consonants else mouth))
+            phonemes.append((mora["vowel_length"], mouth))
+        if phrase.get("pause_mora"):
+            pause = query.get("pauseLength")
+            phonemes.append(((phrase["pause_mora"]["vowel_length"] if pause is None else pause) * pause_scale, 0))
+
+    speed = query.get("speedScale") or 1.0
+    intervals = []
+    t = offset
+    for length, mouth in phonemes:
+        length /= speed
+        if mouth and length > 0:
+            intervals.append([t, t + length, mouth])
+        t += length
+    return intervals
+
+def mouth_track(intervals, frame_count, fps):
+    mouth = np.zeros(frame_count, dtype=np.uint8)
+    for start, end, shape in intervals:
+        mouth[int(round(start * fps)):int(round(end * fps))] = shape
+    return mouth
+
+def state_runs(states):
+    # 表情タイムラインのランレングス表現 [開始フレーム, フレーム数, 表情番号]
+    states = np.asarray(states)
+    if len(states) == 0:
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(states)) + 1))
+    lengths = np.diff(np.append(starts, len(states)))
+    return [[int(start), int(length), int(states[start])] for start, length in zip(starts, lengths)]
+
+def expand_state_runs(runs):
+    return np.repeat(np.array([run[2] for run in runs], dtype=np.uint8), [run[1] for run in runs])
+
+def character_clip(character, states, position, resolution, fps, duration):
+    # 表情タイムラインから立ち絵レイヤーを作る　fps はタイムラインのフレームレート
+    sprites = sprite_cache.preload(character, resolution)
+
+    # 表情ごとの RGB / マスク配列を1回だけ作り、同じ表情が続く間は同じバッファを返す（一時PNGなし）
+    rgb_frames = [np.array(sprites[state])[:, :, :3] for state in sprite_states]
+    mask_frames = [np.array(sprites[state])[:, :, 3] / 255.0 for state in sprite_states]
+
+    def make_frame(t):
+        frame = min(int(t * fps), len(states) - 1)
+        return states[frame]
+
+    video = mp.VideoClip(lambda t: rgb_frames[make_frame(t)], duration=duration)
+    mask = mp.VideoClip(lambda t: mask_frames[make_frame(t)], ismask=True, duration=duration)
+    video = video.set_mask(mask)
+    video = video.set_fps(fps)
+
+    pos = sprite_position(position, resolution, video.size)
+    if pos is None:
+        video = video.set_opacity(0)
+    else:
+        video = video.set_position(pos)
+    return video
+
+def sprite_position(position, resolution, size):
+    # 横位置 → 立ち絵左上の座標（縦は中央）　hidden は None
+    y_pos = int((resolution[1] - size[1]) / 2)
+    if position == "left_25":
+        x_pos = int(resolution[0] * 0.25 - size[0] / 2)
+    elif position == "right_25":
+        x_pos = int(resolution[0] * 0.75 - size[0] / 2)
+    elif position == "left_10":
+        x_pos = int(resolution[0] * 0.10 - size[0] / 2)
+    elif position == "right_10":
+        x_pos = int(resolution[0] * 0.90 - size[0] / 2)
+    elif position == "hidden":
+        return None
+    else:
+        x_pos = int((resolution[0] - size[0]) / 2)
+    return x_pos, y_pos
+
+caption_font_path = "font/NotoSansJP-Medium.otf"
+layout_resolution = resolution   # テロップのフォントサイズ・余白の基準
+
+def wrap_text(text, font, max_width):
+    # 改行に加えて幅を超えたら折り返す（日本語は単語の区切りがないので1文字単位）
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ""
+        for char in paragraph:
+            if line and font.getlength(line + char) > max_width:
+                lines.append(line)
+                line = char
+            else:
+                line += char
+        lines.append(line)
+    return lines
+
+def add_text(image, text, font_size, font_color, border_color, position, stroke_width=2, font_path=caption_font_path):
+    # 縁取り文字を描く　縁取りは stroke_width で1回の描画（8方向にずらして重ね描きしない）
+    draw = ImageDraw.Draw(image)
+    font = caption_renderer.font(font_size, font_path)
+    width, height = image.size
+
+    lines = wrap_text(text, font, width - 20)
+    sizes = []
+    for line in lines:
+        text_bbox = draw.textbbox((0, 0), line, font=font, stroke_width=stroke_width)
+        sizes.append((text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]))
+    total_height = sum(text_height for text_width, text_height in sizes)
+
+    if position == "center":
+        y_offset = (height - total_height) / 2
+    elif position == "bottom":
+        y_offset = height - total_height - 50
+    else:
+        y_offset = 10
+
+    for line, (text_width, text_height) in zip(lines, sizes):
+        if position in ("center", "bottom"):
+            x = (width - text_width) / 2
+        else:
+            x = 10
+        draw.text((x, y_offset), line, font=font, fill=font_color, stroke_width=stroke_width, stroke_fill=border_color)
+        y_offset += text_height
+
+    return image
+
+class CaptionRenderer:
+    # タイトル・字幕の描画キャッシュ　フォントは (パス, サイズ)、描画結果は (テキスト, スタイル, 解像度) ごとに1回だけ
+    def __init__(self, max_bitmaps=256):
+        self.fonts = {}
+        self.bitmaps = {}
+        self.max_bitmaps = max_bitmaps
+        self.lock = threading.Lock()
+
+    def font(self, size, path=caption_font_path):
+        key = (path, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = ImageFont.truetype(path, size)
+        return font
+
+    def render(self, text, font_size, font_color, border_color, position, resolution, stroke_width=2):
+        # 不透明部分だけに切り抜いた RGBA 配列と配置位置 (rgba, x, y)　何も描かれなければ None
+        key = (text, font_size, font_color, border_color, position, tuple(resolution), stroke_width)
+        with self.lock:
+            if key in self.bitmaps:
+                return self.bitmaps[key]
+            # フォントサイズ・余白はプロジェクトの解像度基準なので、そこで描いてから縮小する（下書き用）
+            image = Image.new("RGBA", layout_resolution, (0, 0, 0, 0))
+            add_text(image, text, font_size, font_color, border_color, position, stroke_width)
+            if tuple(resolution) != layout_resolution:
+                image = image.resize(tuple(resolution), Image.Resampling.LANCZOS)
+            rgba = np.array(image)
+            rows = np.flatnonzero(rgba[:, :, 3].any(axis=1))
+            cols = np.flatnonzero(rgba[:, :, 3].any(axis=0))
+            bitmap = None
+            if len(rows):
+                bitmap = (rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], int(cols[0]), int(rows[0]))
+            if len(self.bitmaps) >= self.max_bitmaps:
+                self.bitmaps.pop(next(iter(self.bitmaps)))       # 古いものから捨てる
+            self.bitmaps[key] = bitmap
+            return bitmap
+
+caption_renderer = CaptionRenderer()   # 全レイヤーで共有
+
+def caption_bitmaps(title_settings, subtitle_settings, resolution):
+    # [(rgba, x, y, 開始, 終了)]　タイトルは中央、字幕は下
+    captions = []
+    for settings, position in ((title_settings, "center"), (subtitle_settings, "bottom")):
+        if settings and settings["text"] != "":
+            bitmap = caption_renderer.render(settings["text"], settings["font_size"], settings["font_color"],
+                                             settings["border_color"], position, resolution)
+            if bitmap is not None:
+                start = settings["start_time"]
+                captions.append(bitmap + (start, start + settings["duration"]))
+    return captions
+
+def caption_clips(title_settings, subtitle_settings, resolution):
+    # .mov 書き出し用に、描画済みの字幕を一定の ImageClip（マスク付き）として置く
+    clips = []
+    for rgba, x, y, start, end in caption_bitmaps(title_settings, subtitle_settings, resolution):
+        mask = mp.ImageClip(rgba[:, :, 3] / 255.0, ismask=True)
+        clip = mp.ImageClip(rgba[:, :, :3]).set_mask(mask).set_position((x, y))
+        clips.append(clip.set_start(start).set_duration(end - start))
+    return clips
+
+def line_clip(data, resolution=resolution, fps=fps, with_audio=True):
+    # JSON の表情タイムラインと音声から1行分のレイヤーを組み立てる（.mov をデコードしない）
+    states = expand_state_runs(data["sprite_timeline"])
+    captions = caption_bitmaps(data.get("title_settings"), data.get("subtitle_settings"), resolution)
+    audio = mp.AudioFileClip(os.path.join('audio', data["audio_file"])) if with_audio else None
+    return SpriteLayer(data["character"], states, data["position"], resolution, data.get("fps", fps),
+                       data["duration"], captions=captions, audio=audio)
+
+class Premultiplied:
+    # 乗算済みαの画像　不透明部分のバウンディングボックスだけを保持
+    def __init__(self, premul, inv_alpha, x, y):
+        self.premul = premul          # RGB * α  (float32, h x w x 3)
+        self.inv_alpha = inv_alpha    # 1 - α    (float32, h x w x 1)
+        self.x = x
+        self.y = y
+
+def premultiply(rgb, alpha, x=0, y=0):
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if len(rows) == 0:
+        return Premultiplied(np.zeros((0, 0, 3), np.float32), np.ones((0, 0, 1), np.float32), x, y)
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    a = alpha[top:bottom, left:right, np.newaxis].astype(np.float32)
+    premul = rgb[top:bottom, left:right].astype(np.float32)
+    premul *= a
+    return Premultiplied(premul, 1 - a, x + int(left), y + int(top))
+
+def blend_premultiplied(out, sprite, x=0, y=0):
+    # out (float32) のバウンディングボックス範囲だけをその場で合成　新しい配列は作らない
+    h, w = sprite.inv_alpha.shape[:2]
+    x, y = x + sprite.x, y + sprite.y
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, out.shape[1]), min(y + h, out.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    region = out[y0:y1, x0:x1]
+    src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    np.multiply(region, sprite.inv_alpha[src], out=region)
+    np.add(region, sprite.premul[src], out=region)
+
+class BlendLayer(ABC):
+    # LayeredCompositeClip 上に直接合成するレイヤーの共通部分
+    # moviepy のクリップと同じく start / end / duration / audio / set_start / subclip を持つ
+    # サブクラスは blend_into を実装する（なければ生成時にエラー）
+    start = 0
+    offset = 0
+    audio = None
+    duration = 0
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    def set_start(self, t):
+        layer = copy.copy(self)
+        layer.start = t
+        return layer
+
+    def subclip(self, t_start=0, t_end=None):
+        layer = copy.copy(self)
+        t_end = self.duration if t_end is None else t_end
+        layer.offset = self.offset + t_start
+        layer.duration = t_end - t_start
+        if self.audio is not None:
+            layer.audio = self.audio.subclip(t_start, min(t_end, self.audio.duration))
+        return layer
+
+    @abstractmethod
+    def blend_into(self, out, t):
+        # 時刻 t のフレームを out（float32 の RGB キャンバス）へ合成する
+        pass
+
+class SpriteLayer(BlendLayer):
+    # 立ち絵タイムラインと字幕のレイヤー
+    def __init__(self, character, states, position, resolution, fps, duration, captions=(), audio=None):
+        self.states = states
+        self.fps = fps
+        self.duration = duration
+        self.audio = audio
+        self.sprites = [sprite_cache.premultiplied(character, state, resolution) for state in sprite_states]
+        self.pos = sprite_position(position, resolution, sprite_cache.get(character, 'normal', resolution).size)
+
+        # 字幕は描画済みの静止画（caption_bitmaps）なので、1回だけ乗算済みαにしておく
+        self.captions = [(premultiply(rgba[:, :, :3], rgba[:, :, 3] / 255.0, x, y), start, end)
+                         for rgba, x, y, start, end in captions]
+
+    def blend_into(self, out, t):
+        ct = t - self.start + self.offset
+        if self.pos is not None:
+            frame = min(max(int(ct * self.fps), 0), len(self.states) - 1)
+            blend_premultiplied(out, self.sprites[self.states[frame]], *self.pos)
+        for sprite, start, end in self.captions:
+            if start <= ct and (end is None or ct < end):
+                blend_premultiplied(out, sprite)
+
+class ImageLayer(BlendLayer):
+    # 静止画背景　中央に配置した1枚を毎フレームそのまま合成する
+    def __init__(self, rgba, resolution, duration):
+        self.duration = duration
+        x_pos = int((resolution[0] - rgba.shape[1]) / 2)
+        y_pos = int((resolution[1] - rgba.shape[0]) / 2)
+        self.sprite = premultiply(rgba[:, :, :3], rgba[:, :, 3] / 255.0, x_pos, y_pos)
+
+    def blend_into(self, out, t):
+        blend_premultiplied(out, self.sprite)
+
+background_image_types = ('.png', '.jpg', '.jpeg')
+
+def scaled_background(path, resolution, cache_dir="cache/backgrounds"):
+    # 出力解像度に縮小済みの背景画像をディスクにキャッシュ　(ファイル, 更新日時, 解像度) ごとに1回だけ
+    stat = os.stat(path)
+    source = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{resolution[0]}x{resolution[1]}"
+    cached = os.path.join(cache_dir, hashlib.sha256(source.encode('utf-8')).hexdigest() + ".png")
+    if not os.path.exists(cached):
+        img = Image.open(path).convert("RGBA")
+        if img.height > resolution[1]:
+            img = img.resize((int(img.width * (resolution[1] / img.height)), resolution[1]), Image.Resampling.LANCZOS)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cached + ".tmp.png"
+        img.save(tmp_path)
+        os.replace(tmp_path, cached)
+    return np.array(Image.open(cached).convert("RGBA"))
+
+def probe_media(path):
+    # 背景ファイルの長さ・フレームレート・サイズ　動画はヘッダだけ読む（デコードしない）
+    if path.lower().endswith(background_image_types):
+        with Image.open(path) as img:
+            return {"type": "image", "size": list(img.size)}
+    infos = ffmpeg_parse_infos(path)
+    return {"type": "video", "duration": infos["duration"], "fps": infos.get("video_fps"),
+            "size": list(infos["video_size"]), "audio": infos["audio_found"]}
+
+def background_proxy_path(path, resolution=resolution, fps=fps, cache_dir="cache/proxies"):
+    # (ファイル, 更新日時, 解像度, フレームレート) ごと　元ファイルを差し替えたら別のプロキシになる
+    stat = os.stat(path)
+    source = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{resolution[0]}x{resolution[1]}|{fps}"
+    return os.path.join(cache_dir, hashlib.sha256(source.encode('utf-8')).hexdigest() + ".mp4")
+
+def make_background_proxy(path, resolution=resolution, fps=fps, cache_dir="cache/proxies"):
+    # 全フレームがキーフレームの H.264（シークが軽い）をプロジェクトの解像度・フレームレートで作る
+    # fastdecode（CABAC・デブロックなし）でデコードも軽くする　音声は元ファイルから取るので入れない
+    proxy = background_proxy_path(path, resolution, fps, cache_dir)
+    if os.path.exists(proxy):
+        return proxy
+    height = min(ffmpeg_parse_infos(path)['video_size'][1], resolution[1]) // 2 * 2
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = proxy + ".part.mp4"
+    subprocess_call([get_setting("FFMPEG_BINARY"), "-y", "-i", path, "-an", "-vf", f"scale=-2:{height}", "-r", str(fps),
+                     "-c:v", "libx264", "-preset", "veryfast", "-tune", "fastdecode", "-crf", "18", "-g", "1", "-pix_fmt", "yuv420p", tmp_path],
+                    logger=None)
+    os.replace(tmp_path, proxy)
+    return proxy
+
+def background_source(path, use_proxy=False):
+    # プロキシができていればそちらをデコードする（作成前・元ファイルの差し替え後は元ファイル）
+    if use_proxy and not path.lower().endswith(background_image_types):
+        proxy = background_proxy_path(path)
+        if os.path.exists(proxy):
+            return proxy
+    return path
+
+def background_clip(path, resolution, duration):
+    if path.lower().endswith(background_image_types):
+        return ImageLayer(scaled_background(path, resolution), resolution, duration)
+
+    # 動画は出力より大きい場合だけ ffmpeg 側で縮小してからデコードする
+    clip_height = ffmpeg_parse_infos(path)['video_size'][1]
+    if clip_height > resolution[1]:
+        clip = mp.VideoFileClip(path, has_mask=True, target_resolution=(resolution[1], None))
+    else:
+        clip = mp.VideoFileClip(path, has_mask=True)
+    if clip.duration > duration:
+        clip = clip.subclip(0, duration)
+    return clip.set_position(("center", "center"))
+
+def pcm16(rate, data, target_rate, channels):
+    # WAV のサンプルを int16・(サンプル数, チャンネル数) に揃える　サンプリング周波数が違えば線形補間
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    if data.dtype.kind == 'f':
+        data = np.clip(data * 32767.0, -32768, 32767)
+    elif data.dtype == np.uint8:
+        data = (data.astype(np.int16) - 128) * 256
+    elif data.dtype.itemsize > 2:
+        data = data >> (8 * data.dtype.itemsize - 16)
+    data = data.astype(np.int16)
+    if rate != target_rate and len(data):
+        positions = np.arange(int(len(data) * target_rate / rate)) * (rate / target_rate)
+        data = np.stack([np.interp(positions, np.arange(len(data)), data[:, c]) for c in range(data.shape[1])],
+                        axis=1).astype(np.int16)
+    if data.shape[1] != channels:
+        data = np.repeat(data[:, :1], channels, axis=1)
+    return data
+
+@contextmanager
+def job_workspace(temp_root="temp", prefix="job_"):
+    # ジョブごとの作業ディレクトリ　終了時に丸ごと削除する
+    # 作ったプロセスの pid を残しておき、落ちて残ったものだけを remove_stale_workspaces で消す
+    os.makedirs(temp_root, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix=prefix, dir=temp_root)
+    try:
+        with open(os.path.join(workspace, "owner.pid"), "w") as f:
+            f.write(str(os.getpid()))
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def pid_alive(pid):
+    if os.name == 'nt':
+        # Windows の os.kill(pid, 0) は CTRL_C_EVENT になるので使わない
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)       # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259                                 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def remove_stale_workspaces(temp_root="temp"):
+    # 作ったプロセスがもう動いていない作業ディレクトリだけを消す（実行中の一括生成などのものは残す）
+    for owner in glob.glob(os.path.join(temp_root, "*", "owner.pid")):
+        try:
+            with open(owner) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            continue
+        if not pid_alive(pid):
+            shutil.rmtree(os.path.dirname(owner), ignore_errors=True)
+
+character_order_lock = threading.Lock()
+
+class Animator:
+    def __init__(self, character='ずんだもん', speaker=1, resolution=None, synthesis_workers=4, temp_dir='temp',
+                 profile="final"):
+        settings = render_profiles[profile]
+        self.character = character
+        self.speaker = speaker
+        #self.fps = 24
+        self.fps = fps                        # 表情タイムラインのフレームレート（プロファイルによらず同じ）
+        self.video_fps = settings["fps"]      # 書き出しのフレームレート
+        self.preset = settings["preset"]
+        self.resolution = tuple(resolution or settings["resolution"])
+        self.images = self.load_images(character)
+        self.sprites = sprite_cache.preload(character, self.resolution)
+        self.synthesis_workers = synthesis_workers
+        self.voice_generator = VoiceGenerator(max_connections=synthesis_workers)
+        self.image_processor = ImageProcessor(self.resolution)
+        self.temp_dir = temp_dir   # この下にジョブごとの作業ディレクトリを作る
+        os.makedirs(temp_dir, exist_ok=True)
+        os.makedirs('json', exist_ok=True)
+        os.makedirs('video', exist_ok=True)
+        os.makedirs('audio', exist_ok=True)
+
+    def add_text(self, image, text, font_size, font_color, border_color, position):
+        return add_text(image, text, font_size, font_color, border_color, position)
+
+    def load_images(self, character):
+        return character_images.get(character, character_images[character])
+
+    def get_audio_volume(self, audio_path, mode="mean", smoothing=0):
+        rate, data = wavfile.read(audio_path, mmap=True)
+        return self.volume_envelope(data, rate, mode, smoothing)
+
+    def volume_envelope(self, data, rate, mode="mean", smoothing=0):
+        # フレームごとの音量エンベロープ　mode: "mean"(平均絶対値) / "peak" / "rms"
+        duration = len(data) / rate
+        frame_size = max(int(rate / self.fps), 1)
+        frame_count = -(-len(data) // frame_size)          # 末尾の端数ウィンドウも含める
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+
+        # 口パクの閾値は16bit基準なので、他の形式もそのスケールに揃える
+        if data.dtype.kind == 'f':
+            scale, offset = 32768.0, 0.0
+        elif data.dtype == np.uint8:
+            scale, offset = 256.0, -128.0
+        else:
+            scale, offset = 32768.0 / (np.iinfo(data.dtype).max + 1), 0.0
+
+        volumes = np.zeros(frame_count, dtype=np.float32)
+        block = frame_size * 4096                          # メモリ使用量を一定に保つためブロック単位で処理
+        for start in range(0, len(data), block):
+            chunk = (np.asarray(data[start:start + block], dtype=np.float32) + offset) * scale
+            if mode == "peak":
+                samples = np.abs(chunk).max(axis=1)
+            elif mode == "rms":
+                samples = np.square(chunk).mean(axis=1)
+            else:
+                samples = np.abs(chunk).mean(axis=1)
+
+            bounds = np.arange(0, len(samples), frame_size)
+            first = start // frame_size
+            if mode == "peak":
+                volumes[first:first + len(bounds)] = np.maximum.reduceat(samples, bounds)
+            else:
+                counts = np.diff(np.append(bounds, len(samples)))
+                volumes[first:first + len(bounds)] = np.add.reduceat(samples, bounds) / counts
+
+        if mode == "rms":
+            volumes = np.sqrt(volumes)
+        if smoothing > 1:
+            volumes = np.convolve(volumes, np.ones(smoothing) / smoothing, mode='same').astype(np.float32)
+        return volumes, duration
+
+    def build_state_timeline(self, volumes, total_duration, mouth=None):
+        # フレームごとの表情番号（口 0-2 + 目閉じ 3）　sprite_states のインデックス
+        # mouth: モーラから作った口のトラック（なければ音量から）
+        frame_count = max(int(total_duration * self.fps), 1)
+        if mouth is None:
+            volumes = np.asarray(volumes, dtype=float)[:frame_count]
+            mouth = np.zeros(frame_count, dtype=np.uint8)
+            mouth[:len(volumes)] = np.digitize(volumes, mouth_thresholds)
+        else:
+            mouth = mouth[:frame_count]
+
+        blink = np.zeros(frame_count, dtype=bool)          # まばたきはビットマスク
+        blink[random.sample(range(frame_count), min(int(total_duration), frame_count))] = True
+
+        return mouth + 3 * blink.astype(np.uint8)
+
+    def write_clip(self, clip, mov_file, mp4_file=None, audiofile=None, progress_callback=None):
+        # 1回のレンダリングで α付き .mov と グレー背景プレビュー .mp4 の両方のエンコーダーへ送る
+        nframes = max(int(clip.duration * self.video_fps), 1)
+        with ExitStack() as stack:
+            mov_writer = stack.enter_context(FFMPEG_VideoWriter(
+                mov_file, clip.size, self.video_fps, codec="qtrle", audiofile=audiofile,
+                withmask=True, ffmpeg_params=["-pix_fmt", "argb"]))
+            mp4_writer = None
+            if mp4_file:
+                mp4_writer = stack.enter_context(FFMPEG_VideoWriter(
+                    mp4_file, clip.size, self.video_fps, codec="libx264", preset=self.preset, audiofile=audiofile,
+                    ffmpeg_params=["-pix_fmt", "yuv420p", "-acodec", "aac"]))
+
+            for i, (t, frame) in enumerate(clip.iter_frames(fps=self.video_fps, with_times=True, dtype="uint8")):
+                # 透明背景の合成結果は黒の上に乗った乗算済みα
+                mask = clip.mask.get_frame(t)
+                alpha = mask[:, :, np.newaxis]
+                # qtrle の argb はストレートαなので α で割って戻す
+                straight = np.where(alpha > 0, frame / np.maximum(alpha, 1e-6), 0)
+                mov_writer.write_frame(np.dstack([np.clip(np.round(straight), 0, 255).astype("uint8"),
+                                                  (255 * mask).astype("uint8")]))
+                if mp4_writer:
+                    mp4_writer.write_frame((frame + 128 * (1 - alpha)).astype("uint8"))
+                if progress_callback:
+                    progress_callback(int((i + 1) / nframes * 100))
+        return mov_file, mp4_file
+
+    def assemble_audio(self, plan, default_pause=5):
+        # セリフの WAV と無音ブロックを NumPy の PCM バッファへ直接並べる（サンプルごとのコールバックなし）
+        # 形式は最初のセリフに揃える（VOICEVOX の出力はふつう全部同じ）
+        # (サンプリング周波数, PCM, plan の各項目の開始秒) を返す
+        voices = {item[2]: wavfile.read(item[2]) for item in plan if item[0] == "voice"}
+        rate = next(iter(voices.values()))[0] if voices else 44100
+        channels = max((data.shape[1] if data.ndim > 1 else 1 for _, data in voices.values()), default=1)
+
+        pieces = []
+        starts = []
+        position = 0
+        for item in plan:
+            starts.append(position / rate)
+            if item[0] == "pause":
+                pieces.append(np.zeros((int(item[1] * rate), channels), dtype=np.int16))
+                position += len(pieces[-1])
+            else:
+                pieces.append(pcm16(*voices[item[2]], rate, channels))
+                position += len(pieces[-1])
+                pieces.append(np.zeros((int(default_pause * rate), channels), dtype=np.int16))
+                position += len(pieces[-1])
+        if not pieces:
+            return rate, np.zeros((0, channels), dtype=np.int16), starts
+        return rate, np.concatenate(pieces), starts
+
+    def mora_intervals(self, plan, starts):
+        # 各セリフのクエリを組み立て後の位置（[N] の無音・既定の間を含む）へずらして並べる
+        # クエリのない音声が1つでもあれば None（音量エンベロープで代用）
+        intervals = []
+        for item, start in zip(plan, starts):
+            if item[0] == "voice":
+                query = load_query(item[2])
+                if query is None:
+                    print(f"No audio_query for {item[1]}, using waveform lip-sync")
+                    return None
+                intervals += mora_mouth_intervals(query, start)
+        return intervals
+
+    def create_animation(self, text, position="center", 
+                        speaker_id=1, volume=1.0, silence_duration=0, 
+                        title_settings=None, subtitle_settings=None, 
+                        progress_callback=None, start_time=0, output_number=None, layer=None,
+                        preview=True, checkpoint=None, lip_sync="waveform"):
+        # checkpoint: 段階ごとの途中結果（レンダーキューから再開するときは済んだ段階を飛ばす）
+        # lip_sync: "waveform"（音量エンベロープ）/ "mora"（audio_query のモーラ長）
+        checkpoint = checkpoint or JobCheckpoint()
+        # ジョブごとの作業ディレクトリ（並列に複数行を生成しても一時ファイルが衝突しない）
+        with job_workspace(self.temp_dir, prefix="line_") as workspace:
+            print("Starting to create animation")
+            silence_duration = int(silence_duration)
+            if volume == 0:
+                text = '[' + str(silence_duration) + ']'
+            print(text)
+
+            # 出力番号　再開時は最初に採番した番号を使う
+            json_file_number = checkpoint.get("number")
+            if json_file_number is None:
+                json_file_number = output_number if output_number is not None else project_index.allocate_number("output")
+                checkpoint.save("number", json_file_number)
+            final_audio_path = f'audio/output_{json_file_number}.wav'     # 合成時にも使うので残す
+
+            # 1. 音声合成・組み立て
+            pcm = None
+            if checkpoint.get("audio") is None or not os.path.exists(final_audio_path):
+                #segments = re.split(r'(\d+)', text)
+                #segments = re.split(r'(\d+|\n)', text)
+                segments = re.split(r'(\n)', text)
+                segments = [item for item in segments if item]
+                print(segments)
+
+                default_pause = 5
+
+                plan = []   # ("pause", 秒) / ("voice", セリフ, wavパス)　を元の順番で
+                for i, segment in enumerate(segments):
+                    segment = segment.strip()
+                    #if segment.isdigit() and i< len(segments) and segments[i-1] == '[' and segments[i+1] == ']':
+                    if len(segment) >2 and segment[0] == "[" and segment[-1] == "]" and segment[1:-1].isdigit():
+                                plan.append(("pause", int(segment[1:-1])))
+                    elif segment == '\n':
+                                pass
+                    elif segment:
+                        plan.append(("voice", segment, os.path.join(workspace, f"audio_{len(plan)}.wav")))
+
+                # 音声合成は並列に、組み立ては元の順番で
+                voice_jobs = [(item[1], item[2]) for item in plan if item[0] == "voice"]
+                print(f"Generating voice for {len(voice_jobs)} segments")
+                self.voice_generator.generate_voices(voice_jobs, speaker_id, max_workers=self.synthesis_workers)
+                checkpoint.check()
+
+                # PCM のまま組み立てて1回だけ書き出し、エンベロープも同じバッファから計算する
+                rate, pcm, starts = self.assemble_audio(plan, default_pause)
+                wavfile.write(final_audio_path, rate, pcm[:, 0] if pcm.shape[1] == 1 else pcm)
+                # 作業ディレクトリは再開時に残っていないので、モーラの区間もここで保存する
+                intervals = self.mora_intervals(plan, starts) if lip_sync == "mora" else None
+                checkpoint.save("audio", {"duration": len(pcm) / rate, "mouth": intervals})
+            total_duration = checkpoint.get("audio")["duration"]
+            checkpoint.check()
+
+            # 2. 口パク用の音量エンベロープ → 表情タイムライン
+            if checkpoint.get("envelope") is None:
+                intervals = checkpoint.get("audio").get("mouth")
+                if intervals is not None:
+                    # モーラ単位　エンベロープは計算しない
+                    volumes = None
+                    mouth = mouth_track(intervals, max(int(total_duration * self.fps), 1), self.fps)
+                elif pcm is not None:
+                    volumes, _ = self.volume_envelope(pcm, rate)
+                    mouth = None
+                else:
+                    volumes, _ = self.get_audio_volume(final_audio_path)   # 再開時は書き出し済みの WAV から
+                    mouth = None
+                checkpoint.save("envelope", state_runs(self.build_state_timeline(volumes, total_duration, mouth)))
+            states = expand_state_runs(checkpoint.get("envelope"))
+            checkpoint.check()
+
+            # 3. キャラクター動画の書き出し
+            mov_file = f'video/output_{json_file_number}.mov'
+            mp4_file = f'video/output_{json_file_number}.mp4' if preview else None    # グレー背景のプレビュー
+            if checkpoint.get("video") is None or not os.path.exists(mov_file):
+                video = character_clip(self.character, states, position, self.resolution, self.fps, total_duration)
+
+                # 透明背景はメモリ上の一定キャンバス（ffmpeg・一時ファイルなし）
+                final_clip = mp.CompositeVideoClip([video] + caption_clips(title_settings, subtitle_settings, self.resolution),
+                                                   size=self.resolution)
+
+                def render_progress(value):
+                    checkpoint.check()     # キャンセルはフレーム単位で反映
+                    if progress_callback:
+                        progress_callback(value)
+                self.write_clip(final_clip, mov_file, mp4_file, audiofile=final_audio_path, progress_callback=render_progress)
+                checkpoint.save("video", {"mov_file": os.path.basename(mov_file)})
+
+            global default_character_order
+            with character_order_lock:
+                if layer is not None:
+                    pass
+                elif default_character_order is None:
+                    default_character_order = {self.character: 1}
+                    layer = 1
+                elif self.character in default_character_order:
+                    layer = default_character_order[self.character]
+                else:
+                    layer = max(default_character_order.values()) +1
+                    default_character_order.setdefault(self.character, layer)
+
+            json_data = {
+                "mov_file": os.path.basename(mov_file),
+                "mp4_file": os.path.basename(mp4_file) if mp4_file else None,
+                "text": text,
+                "layer": layer,
+                "position": position,
+                "start_time": start_time,
+                "duration": total_duration,
+                "volume": volume,
+                "character": self.character,
+                "speaker_id": speaker_id,
+                "title_settings": title_settings,
+                "subtitle_settings": subtitle_settings,
+                "audio_file": os.path.basename(final_audio_path),
+                "fps": self.fps,
+                "sprite_timeline": state_runs(states)     # [開始フレーム, フレーム数, 表情番号]
+            }
+    
+            project_index.put(f'output_{json_file_number}.json', json_data)   # プロジェクトの索引へ書き出し
+
+            return mov_file, mp4_file
+#########################################################################################################
+class LayeredCompositeClip(mp.VideoClip):
+    # 全レイヤーを1段で合成する　clips はレイヤー順（下から）
+    # 開始・終了時刻の区間インデックスで、各フレームは表示中のクリップだけを処理する
+    def __init__(self, clips, size, duration, bg_color=(0, 0, 0)):
+        super().__init__(duration=duration)
+        self.size = size
+        self.clips = clips
+        self.bg = np.full((size[1], size[0], 3), bg_color, dtype=np.float32)
+        self.canvas = np.empty((size[1], size[0], 3), dtype=np.float32)   # フレーム間で使い回す
+        self.frame = np.empty((size[1], size[0], 3), dtype=np.uint8)
+
+        ends = [clip.end if clip.end is not None else duration for clip in clips]
+        self.bounds = sorted({0.0, duration} | {clip.start for clip in clips} | set(ends))
+        starting = {}
+        ending = {}
+        for order, (clip, end) in enumerate(zip(clips, ends)):
+            if end <= clip.start:
+                continue          # 長さ 0 のクリップは描かない（区間に入れると最後まで残る）
+            starting.setdefault(clip.start, []).append(order)
+            ending.setdefault(end, []).append(order)
+
+        # 区間 [bounds[i], bounds[i+1]) ごとに表示中のクリップ（レイヤー順）
+        self.active = []
+        playing = set()
+        for bound in self.bounds[:-1]:
+            playing.difference_update(ending.get(bound, []))
+            playing.update(starting.get(bound, []))
+            self.active.append([clips[order] for order in sorted(playing)])
+
+        audioclips = [clip.audio.set_start(clip.start) for clip in clips if clip.audio is not None]
+        if audioclips:
+            self.audio = mp.CompositeAudioClip(audioclips).set_duration(duration)
+
+    def playing_clips(self, t):
+        i = bisect.bisect_right(self.bounds, t) - 1
+        if i < 0 or i >= len(self.active):
+            return []
+        return self.active[i]
+
+    def make_frame(self, t):
+        np.copyto(self.canvas, self.bg)
+        for clip in self.playing_clips(t):
+            if isinstance(clip, BlendLayer):
+                clip.blend_into(self.canvas, t)
+            else:
+                self.canvas[:] = clip.blit_on(self.canvas, t)   # 背景動画・旧形式の .mov
+        np.copyto(self.frame, self.canvas, casting='unsafe')
+        return self.frame
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+# タイムラインの1行 = {"layer": レイヤー(0 は背景), "start": 開始, "duration": 長さ, "data": 行の JSON}
+# プロセス間で受け渡せるよう、クリップではなくこの形で持ち回る
+def layer_source(spec):
+    data = spec["data"]
+    if spec["layer"] == 0:
+        return 'source/' + data['background_file']
+    if "sprite_timeline" not in data:
+        return 'video/' + data['mov_file']                 # 旧形式は .mov をデコード
+    return None
+
+def layer_clip(spec, resolution=resolution, fps=fps, with_audio=True, proxies=False):
+    data, duration = spec["data"], spec["duration"]
+    if spec["layer"] == 0:
+        # 静止画は1回だけ縮小して一定レイヤーに　proxies なら背景動画はプロキシから
+        clip = background_clip(background_source(layer_source(spec), proxies), resolution, duration)
+    else:
+        if "sprite_timeline" in data:
+            clip = line_clip(data, resolution, fps, with_audio)           # 立ち絵タイムラインから直接組み立て
+        else:
+            clip = mp.VideoFileClip(layer_source(spec), has_mask=True, audio=with_audio)
+        if clip.duration != duration:
+            clip = clip.subclip(0, duration)
+    return clip.set_start(spec["start"])
+
+def layer_audio_source(spec):
+    # 行の音声ファイル（なければ None）　セリフは audio/ の WAV、背景動画・旧形式 .mov は動画の音声
+    source = layer_source(spec)
+    if source is None:
+        return os.path.join('audio', spec["data"]["audio_file"])
+    if source.lower().endswith(background_image_types):
+        return None
+    media = spec["data"].get("media") or {}   # アップロード時に調べてあればファイルを開かない
+    has_audio = media["audio"] if "audio" in media else ffmpeg_parse_infos(source)['audio_found']
+    return source if has_audio else None
+
+def decode_audio(path, rate, channels, duration=None):
+    # float32 (サンプル数, チャンネル数) で読む　WAV はそのまま、それ以外は ffmpeg で PCM に
+    if path.lower().endswith('.wav'):
+        source_rate, data = wavfile.read(path, mmap=True)
+        if duration is not None:
+            data = data[:int(math.ceil(duration * source_rate))]
+        source_channels = data.shape[1] if data.ndim > 1 else 1
+        data = pcm16(source_rate, data, source_rate, source_channels).astype(np.float32) / 32768.0
+        if source_rate != rate:                            # チャンネルを増やす前にリサンプル（モノラルなら半分の計算量）
+            g = math.gcd(rate, source_rate)
+            data = resample_poly(data, rate // g, source_rate // g, axis=0).astype(np.float32)
+        if source_channels != channels:
+            data = np.repeat(data[:, :1], channels, axis=1) if source_channels < channels else data.mean(axis=1, keepdims=True)
+        return data
+    cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-i", path]
+    if duration is not None:
+        cmd += ["-t", str(duration)]
+    cmd += ["-vn", "-f", "f32le", "-ac", str(channels), "-ar", str(rate), "-"]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(out, dtype=np.float32).reshape(-1, channels)
+
+def mix_timeline_audio(specs, total_duration, path, rate=48000, channels=2):
+    # タイムライン全体の音声を1本の float バッファにミックスする
+    # 各行の音声は1回だけデコードし、ボリューム列のゲインを掛けて開始位置のサンプルへ足し込む
+    mix = np.zeros((int(round(total_duration * rate)), channels), dtype=np.float32)
+    for spec in specs:
+        source = layer_audio_source(spec)
+        if source is None:
+            continue
+        volume = spec["data"].get("volume")
+        gain = 1.0 if volume is None else float(volume)
+        start = int(round(spec["start"] * rate))
+        if gain == 0 or start >= len(mix):
+            continue
+        samples = decode_audio(source, rate, channels, spec["duration"])
+        length = min(len(samples), int(round(spec["duration"] * rate)), len(mix) - start)
+        if length > 0:
+            target = mix[start:start + length]
+            target += samples[:length] * np.float32(gain)
+
+    # クリップ防止　フルスケールを超える場合は全体のゲインを下げる
+    peak = float(np.abs(mix).max()) if len(mix) else 0.0
+    if peak > 1.0:
+        print(f"Audio peak {peak:.2f} > 1.0, scaling mix by {1 / peak:.2f}")
+        mix *= np.float32(1 / peak)
+
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        block = rate * 60                                  # int16 への変換はブロックごと（全体のコピーを作らない）
+        for i in range(0, len(mix), block):
+            f.writeframes((mix[i:i + block] * 32767.0).astype('<i2').tobytes())
+    return path
+
+def layer_signature(spec):
+    # 映像に影響しない項目（音量・グリッド側の開始/長さ）は JSON から外す
+    picture = {key: value for key, value in spec["data"].items() if key not in ("volume", "start_time", "duration")}
+    source = layer_source(spec)
+    return [spec["layer"], spec["start"], spec["duration"], picture, file_signature(source) if source else None]
+
+# 並列レンダリング用ワーカー　合成クリップはプロセスごとに1回だけ組み立てる
+_segment_worker = {}
+
+def _init_segment_worker(renderer, specs, total_duration, progress_queue=None, cancel_event=None):
+    _segment_worker["renderer"] = renderer
+    _segment_worker["clip"] = renderer.composite(specs, total_duration)
+    _segment_worker["progress"] = progress_queue
+    _segment_worker["cancel"] = cancel_event
+    if progress_queue is not None:
+        progress_queue.cancel_join_thread()   # 終了時に読まれない進捗の書き込みを待たない（件数は戻り値で数える）
+
+def _render_segment_chunk(chunk):
+    # 進捗はフレームごとに親プロセスへ送る（チャンクの完了を待たない）
+    # キャンセルはフレームごとに確認し、書きかけのセグメントを捨てて抜ける　戻り値は描いて送ったフレーム数
+    renderer, clip = _segment_worker["renderer"], _segment_worker["clip"]
+    progress_queue, cancel_event = _segment_worker["progress"], _segment_worker["cancel"]
+    sent = [0]
+    def progress(frames):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled()
+        if progress_queue is not None:
+            progress_queue.put(frames)
+            sent[0] += frames
+    try:
+        for first, last, key in chunk:
+            renderer.render_segment(clip, first, last, renderer.segment_path(key), progress)
+    except JobCancelled:
+        pass
+    return sent[0]
+
+class SegmentRenderer:
+    # 最終動画を GOP 単位の固定長セグメントに分けてエンコードする
+    # セグメントのハッシュは重なっているレイヤーの内容から作るので、変更のあった区間だけ再エンコードし
+    # 残りはキャッシュ済みのセグメントを concat demuxer で再エンコードなしにつなぐ
+    # workers > 1 なら再エンコードする区間を連続したチャンクに分けてプロセスプールで並列に処理する
+    format_version = 2   # 描画方法を変えたら上げる（2: Pillow のテロップ）
+
+    def __init__(self, resolution=resolution, fps=fps, segment_seconds=5, preset="medium",
+                 cache_dir="cache/segments", temp_dir="temp", background_proxies=False):
+        self.resolution = resolution
+        self.fps = fps
+        self.background_proxies = background_proxies
+        self.gop = max(int(round(segment_seconds * fps)), 1)   # 1セグメント = 1 GOP（フレーム数）
+        self.preset = preset
+        self.cache_dir = cache_dir
+        self.temp_dir = temp_dir
+        self.ffmpeg_params = ["-pix_fmt", "yuv420p", "-g", str(self.gop), "-keyint_min", str(self.gop),
+                              "-sc_threshold", "0"]
+        os.makedirs(cache_dir, exist_ok=True)
+        os.makedirs(temp_dir, exist_ok=True)
+
+    def segments(self, total_duration):
+        nframes = max(int(total_duration * self.fps), 1)
+        return [(first, min(first + self.gop, nframes)) for first in range(0, nframes, self.gop)]
+
+    def segment_key(self, first, last, specs, signatures):
+        t0, t1 = first / self.fps, last / self.fps
+        overlapping = [signature for spec, signature in zip(specs, signatures)
+                       if spec["start"] < t1 and spec["start"] + spec["duration"] > t0]
+        source = json.dumps([self.format_version, self.resolution, self.fps, self.preset, self.ffmpeg_params, first, last, overlapping],
+                            ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def segment_path(self, key):
+        return os.path.join(self.cache_dir, key + ".mp4")
+
+    def composite(self, specs, total_duration):
+        clips = [layer_clip(spec, self.resolution, self.fps, with_audio=False, proxies=self.background_proxies)
+                 for spec in specs]
+        return LayeredCompositeClip(clips, self.resolution, total_duration)
+
+    def render_segment(self, clip, first, last, path, progress=None):
+        tmp_path = path + ".part.mp4"
+        with FFMPEG_VideoWriter(tmp_path, self.resolution, self.fps, codec="libx264",
+                                preset=self.preset, ffmpeg_params=self.ffmpeg_params) as writer:
+            try:
+                for i in range(first, last):
+                    writer.write_frame(clip.get_frame(i / self.fps))
+                    if progress:
+                        progress(1)
+            except BaseException:
+                writer.close()
+                os.remove(tmp_path)       # 書きかけは残さない
+                raise
+        os.replace(tmp_path, path)
+
+    def chunks(self, segments, count):
+        # 時間順に連続した count 個のチャンクへ分ける
+        count = max(min(count, len(segments)), 1)
+        size, extra = divmod(len(segments), count)
+        chunks, i = [], 0
+        for n in range(count):
+            step = size + (1 if n < extra else 0)
+            chunks.append(segments[i:i + step])
+            i += step
+        return chunks
+
+    def render_segments(self, specs, total_duration, segments, workers=1, chunks=None, progress=None):
+        if not segments:
+            return
+        chunks = self.chunks(segments, chunks or workers)
+        if workers <= 1 or len(chunks) == 1:
+            clip = self.composite(specs, total_duration)
+            for first, last, key in segments:
+                self.render_segment(clip, first, last, self.segment_path(key), progress)
+            return
+        # progress はキャンセルの確認も兼ねるので、描き終わったフレームがなくても一定間隔で呼ぶ
+        progress_queue = multiprocessing.Queue()
+        cancel_event = multiprocessing.Event()
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_init_segment_worker,
+                                       initargs=(self, specs, total_duration, progress_queue, cancel_event))
+        try:
+            pending = {executor.submit(_render_segment_chunk, chunk) for chunk in chunks}
+            sent = received = 0
+            while pending:
+                done, pending = wait(pending, timeout=0.5)
+                for future in done:
+                    sent += future.result()
+                frames = self.drain(progress_queue)
+                received += frames
+                if progress:
+                    progress(frames)
+            # 最後のチャンクの進捗がまだキューの途中にあれば、送られた分を全部受け取るまで待つ
+            frames = 0
+            while received + frames < sent:
+                frames += progress_queue.get(timeout=5)
+            if progress and frames:
+                progress(frames)
+        except BaseException:
+            # キャンセル・エラー時は待機中のチャンクを取り消し、実行中のチャンクには次のフレームで抜けてもらう
+            cancel_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    def drain(self, progress_queue):
+        frames = 0
+        while True:
+            try:
+                frames += progress_queue.get_nowait()
+            except queue.Empty:
+                return frames
+
+    def mix_audio(self, specs, total_duration):
+        # 音声はタイムライン全体で1回だけミックスする（映像のフレームレートとは無関係）
+        if not any(layer_audio_source(spec) for spec in specs):
+            return None
+        return mix_timeline_audio(specs, total_duration, os.path.join(self.temp_dir, "mix.wav"))
+
+    def concat(self, paths, output, audiofile=None):
+        list_file = os.path.join(self.temp_dir, "segments.txt")
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for path in paths:
+                f.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+        cmd = [get_setting("FFMPEG_BINARY"), "-y", "-f", "concat", "-safe", "0", "-i", list_file]
+        if audiofile:
+            cmd += ["-i", audiofile, "-map", "0:v", "-map", "1:a", "-c:a", "aac"]
+        cmd += ["-c:v", "copy", "-movflags", "+faststart", output]
+        subprocess_call(cmd, logger=None)
+
+    def render(self, specs, total_duration, output, progress_callback=None, workers=1, chunks=None):
+        signatures = [layer_signature(spec) for spec in specs]
+        segments = [(first, last, self.segment_key(first, last, specs, signatures))
+                    for first, last in self.segments(total_duration)]
+        dirty = [(first, last, key) for first, last, key in segments if not os.path.exists(self.segment_path(key))]
+        print(f"Segments: {len(dirty)}/{len(segments)} to render")
+
+        total_frames = sum(last - first for first, last, key in dirty)
+        done = [0]
+        def progress(frames):
+            done[0] += frames
+            if progress_callback:
+                progress_callback(min(int(done[0] / total_frames * 100), 99))   # 100 は連結後
+        self.render_segments(specs, total_duration, dirty, workers, chunks, progress)
+
+        audiofile = self.mix_audio(specs, total_duration)
+        paths = [self.segment_path(key) for first, last, key in segments]
+        self.concat(paths, output, audiofile)
+
+        # 今回のタイムラインで使っていないセグメントを削除
+        used = set(os.path.abspath(path) for path in paths)
+        for path in glob.glob(os.path.join(self.cache_dir, "*.mp4")):
+            if os.path.abspath(path) not in used:
+                os.remove(path)
+
+        if progress_callback:
+            progress_callback(100)
+        return output, len(dirty), len(segments)
+
+#########################################################################################################
+# レンダーキュー　生成・結合ジョブを project.db に保存し、アプリが落ちても途中の段階から再開する
+class JobCancelled(Exception):
+    pass
+
+class JobCheckpoint:
+    # ジョブの段階ごとの途中結果　save するたびにキューへ書き込む（queue なしならメモリ上だけ）
+    def __init__(self, queue=None, job_id=None, stages=None):
+        self.queue = queue
+        self.job_id = job_id
+        self.stages = stages or {}
+
+    def get(self, stage):
+        return self.stages.get(stage)
+
+    def save(self, stage, value):
+        self.stages[stage] = value
+        if self.queue:
+            self.queue.save_checkpoint(self.job_id, self.stages)
+
+    def check(self):
+        if self.queue and self.queue.cancel_requested(self.job_id):
+            raise JobCancelled(f"job {self.job_id} cancelled")
+
+class RenderQueue:
+    # status: queued → running → done / failed / cancelled　優先度の高い順、同じ優先度なら投入順
+    def __init__(self, index=project_index):
+        self.index = index
+
+    def submit(self, kind, params, priority=0):
+        now = time.time()
+        with self.index.lock:
+            conn = self.index.connect()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, priority, status, params, checkpoint, created, updated) "
+                    "VALUES (?, ?, 'queued', ?, '{}', ?, ?)",
+                    (kind, priority, json.dumps(params, ensure_ascii=False), now, now))
+        return cursor.lastrowid
+
+    def claim(self):
+        # 次のジョブを取り出して running にする（複数のワーカーが同じジョブを取らないよう書き込みロック内で）
+        with self.index.lock:
+            conn = self.index.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT id, kind, params, checkpoint FROM jobs WHERE status = 'queued' "
+                                   "ORDER BY priority DESC, id LIMIT 1").fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row[0]))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {"id": row[0], "kind": row[1], "params": json.loads(row[2]), "checkpoint": json.loads(row[3])}
+
+    def execute(self, sql, args):
+        with self.index.lock:
+            conn = self.index.connect()
+            with conn:
+                return conn.execute(sql, args).rowcount
+
+    def save_checkpoint(self, job_id, stages):
+        self.execute("UPDATE jobs SET checkpoint = ?, updated = ? WHERE id = ?",
+                     (json.dumps(stages, ensure_ascii=False), time.time(), job_id))
+
+    def finish(self, job_id, status, error=None):
+        self.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?", (status, error, time.time(), job_id))
+
+    def cancel(self, job_id=None):
+        # 待機中はその場で取り消し、実行中は次のチェックで JobCancelled になる　job_id なしなら全部
+        where, args = ("", ()) if job_id is None else (" AND id = ?", (job_id,))
+        self.execute("UPDATE jobs SET status = 'cancelled' WHERE status = 'queued'" + where, args)
+        self.execute("UPDATE jobs SET cancel = 1 WHERE status = 'running'" + where, args)
+
+    def cancel_requested(self, job_id):
+        with self.index.lock:
+            row = self.index.connect().execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def resume(self):
+        # 前回終了時に running のままだったジョブ（クラッシュ・強制終了）を待機に戻す
+        # キャンセル要求済みのまま落ちたジョブは取り消し済みにする
+        self.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE status = 'running' AND cancel = 1",
+                     (time.time(),))
+        return self.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND cancel = 0", ())
+
+    def jobs(self, statuses=("queued", "running")):
+        marks = ", ".join("?" for _ in statuses)
+        with self.index.lock:
+            return self.index.connect().execute(
+                f"SELECT id, kind, priority, status FROM jobs WHERE status IN ({marks}) ORDER BY priority DESC, id",
+                tuple(statuses)).fetchall()
+
+def run_generate_job(params, checkpoint, progress_callback):
+    params = dict(params)
+    animator = Animator(character=params.pop("character"), speaker=params["speaker_id"],
+                        profile=params.pop("profile", "final"))
+    return animator.create_animation(**params, progress_callback=progress_callback, checkpoint=checkpoint)
+
+def run_compose_job(params, checkpoint, progress_callback):
+    # レンダリング済みのチャンクはセグメントキャッシュ（内容ハッシュ）に残るので、再開時は未完了の区間だけを描く
+    def progress(value):
+        checkpoint.check()
+        progress_callback(value)
+    with job_workspace(prefix="combine_") as workspace:
+        renderer = SegmentRenderer(tuple(params["resolution"]), params["fps"], preset=params.get("preset", "medium"),
+                                   cache_dir=params.get("segment_cache", "cache/segments"), temp_dir=workspace,
+                                   background_proxies=params.get("background_proxy", False))
+        return renderer.render(params["specs"], params["total_duration"], params["output"], progress,
+                               workers=params.get("workers", 1))
+
+def run_proxy_job(params, checkpoint, progress_callback):
+    # アップロードした背景動画のプロキシ（作成中は元ファイルのまま合成できる）
+    checkpoint.check()
+    proxy = make_background_proxy(params["source"])
+    progress_callback(100)
+    return proxy
+
+job_handlers = {"generate": run_generate_job, "compose": run_compose_job, "proxy": run_proxy_job}
+
+class RenderWorker(threading.Thread):
+    # キューのジョブを1件ずつ処理するバックグラウンドスレッド
+    # on_progress(job, 0-100) / on_finished(job, status, 結果 or エラー文字列)
+    def __init__(self, queue, on_progress=None, on_finished=None, poll_interval=1.0):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.poll_interval = poll_interval
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+    def notify(self):
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+                continue
+
+            checkpoint = JobCheckpoint(self.queue, job["id"], job["checkpoint"])
+            def progress(value, job=job):
+                if self.on_progress:
+                    self.on_progress(job, value)
+            try:
+                result = job_handlers[job["kind"]](job["params"], checkpoint, progress)
+                status = "done"
+            except JobCancelled:
+                result, status = None, "cancelled"
+            except Exception as e:
+                traceback.print_exc()
+                result, status = str(e), "failed"
+            self.queue.finish(job["id"], status, result if status == "failed" else None)
+            if self.on_finished:
+                self.on_finished(job, status, result)
+
+#########################################################################################################
+class WriteVideoProgress(ProgressBarLogger):
+    def __init__(self, progress_callback, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.progress_callback = progress_callback
+        self.reading_audio = False
+
+    def callback(self, *_, **__):
+        pass
+
+    def bars_callback(self, bar, attr, value, old_value=None): 
+        total = self.bars[bar]["total"]
+        if total > 0:
+            progress = int((value / total) * 100)
+            self.progress_callback(progress)
+            print(f"Progress: {progress}%")
@@ -0,0 +1,112 @@
+import os
+import sys
+import csv
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from animation_core import character_data, project_index, Animator
+
+# 台本ファイル (CSV / JSON) から全セリフのキャラクター動画を wx なしで生成する
+#
+#   python batch_render.py script.csv --workers 8
+#
+# 列: character, style, text, position, start, volume, silence_duration,
+#     title_text, title_font_size, title_font_color, title_border_color, title_start_time, title_duration,
+#     subtitle_text, subtitle_font_size, subtitle_font_color, subtitle_border_color, subtitle_start_time, subtitle_duration
+
+caption_defaults = {
+    "title": {"font_size": 40, "font_color": "white", "border_color": "black", "start_time": 0, "duration": 5},
+    "subtitle": {"font_size": 30, "font_color": "white", "border_color": "black", "start_time": 0, "duration": 5},
+}
+
+def load_script(script_path):
+    if script_path.endswith(".json"):
+        with open(script_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    with open(script_path, 'r', encoding='utf-8-sig', newline='') as f:
+        return list(csv.DictReader(f))
+
+def value(row, key, default):
+    item = row.get(key)
+    return default if item is None or item == "" else item
+
+def speaker_for(character, style):
+    style = str(style)
+    if style.isdigit():
+        return int(style)
+    return character_data[character][style]
+
+def caption_settings(row, prefix):
+    defaults = caption_defaults[prefix]
+    return {
+        "text": str(value(row, f"{prefix}_text", "")).strip(),
+        "font_size": int(value(row, f"{prefix}_font_size", defaults["font_size"])),
+        "font_color": value(row, f"{prefix}_font_color", defaults["font_color"]),
+        "border_color": value(row, f"{prefix}_border_color", defaults["border_color"]),
+        "start_time": float(value(row, f"{prefix}_start_time", defaults["start_time"])),
+        "duration": float(value(row, f"{prefix}_duration", defaults["duration"])),
+    }
+
+def make_jobs(rows):
+    # 出力番号は索引で採番（GUI や他の一括生成と同時に動いても衝突しない）、レイヤーは親プロセスで決める
+    layers = {}
+    jobs = []
+    for row in rows:
+        character = value(row, "character", "ずんだもん")
+        layers.setdefault(character, len(layers) + 1)
+        jobs.append({
+            "character": character,
+            "speaker_id": speaker_for(character, value(row, "style", "ノーマル")),
+            "text": str(value(row, "text", "")),
+            "position": value(row, "position", "center"),
+            "start_time": float(value(row, "start", 0)),
+            "volume": float(value(row, "volume", 1.0)),
+            "silence_duration": int(value(row, "silence_duration", 5)),
+            "title_settings": caption_settings(row, "title"),
+            "subtitle_settings": caption_settings(row, "subtitle"),
+            "output_number": project_index.allocate_number("output"),
+            "layer": layers[character],
+        })
+    return jobs
+
+def render_job(job, synthesis_workers=4, preview=True, lip_sync="waveform", profile="final"):
+    # create_animation がジョブごとの作業ディレクトリを使うので、ワーカー間で一時ファイルは衝突しない
+    animator = Animator(character=job["character"], speaker=job["speaker_id"], synthesis_workers=synthesis_workers,
+                        profile=profile)
+    return animator.create_animation(
+        text=job["text"], position=job["position"],
+        speaker_id=job["speaker_id"], volume=job["volume"], silence_duration=job["silence_duration"],
+        title_settings=job["title_settings"], subtitle_settings=job["subtitle_settings"],
+        start_time=job["start_time"], output_number=job["output_number"], layer=job["layer"],
+        preview=preview, lip_sync=lip_sync,
+    )
+
+def render_script(script_path, workers=None, synthesis_workers=4, preview=True, lip_sync="waveform", profile="final"):
+    jobs = make_jobs(load_script(script_path))
+    os.makedirs('video', exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(jobs), 1))) as executor:
+        futures = {executor.submit(render_job, job, synthesis_workers, preview, lip_sync, profile): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            results[i] = future.result()
+            print(f"[{done}/{len(jobs)}] {results[i][0]}: {jobs[i]['text']}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="台本ファイルからキャラクター動画を一括生成")
+    parser.add_argument("script", help="CSV または JSON の台本ファイル")
+    parser.add_argument("--workers", type=int, default=None, help="並列プロセス数（既定: CPU コア数）")
+    parser.add_argument("--synthesis-workers", type=int, default=4, help="1行あたりの音声合成並列数")
+    parser.add_argument("--no-preview", action="store_true", help="グレー背景のプレビュー .mp4 を書き出さない")
+    parser.add_argument("--lip-sync", choices=["waveform", "mora"], default="waveform",
+                        help="口パクを音量から作るか、audio_query のモーラ長から作るか")
+    parser.add_argument("--draft", action="store_true", help="下書き（640x360, 15fps, ultrafast）で書き出す")
+    args = parser.parse_args(argv)
+    render_script(args.script, workers=args.workers, synthesis_workers=args.synthesis_workers,
+                  preview=not args.no_preview, lip_sync=args.lip_sync, profile="draft" if args.draft else "final")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+import moviepy.editor as mp
+
+from animation_core import resolution, fps, character_clip, SpriteLayer, LayeredCompositeClip
+
+# キャラクター合成のベンチマーク
+#   CompositeVideoClip（全画面 RGBA ブレンド）と LayeredCompositeClip + SpriteLayer
+#   （バウンディングボックス内だけの乗算済みα合成）を 1080p で比較する
+#
+#   python benchmark_blend.py --frames 90
+
+characters = ['ずんだもん', '四国めたん']
+positions = ['left_10', 'left_25', 'center', 'right_25', 'right_10']
+
+def make_layers(count, duration, seed=0):
+    rng = np.random.default_rng(seed)
+    frame_count = int(duration * fps)
+    layers = []
+    for i in range(count):
+        states = rng.integers(0, 6, frame_count).astype(np.uint8)
+        layers.append((characters[i % len(characters)], states, positions[i % len(positions)]))
+    return layers
+
+def time_frames(clip, frames):
+    clip.get_frame(0)                         # 立ち絵キャッシュの準備は計測しない
+    started = time.perf_counter()
+    for i in range(frames):
+        clip.get_frame(i / fps)
+    return (time.perf_counter() - started) / frames
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="キャラクター合成のベンチマーク")
+    parser.add_argument("--frames", type=int, default=90)
+    parser.add_argument("--counts", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args(argv)
+
+    duration = args.frames / fps + 1
+    print(f"{resolution[0]}x{resolution[1]}, {args.frames} frames")
+    print(f"{'characters':>10} {'CompositeVideoClip':>20} {'SpriteLayer':>14} {'speedup':>8}")
+    for count in args.counts:
+        layers = make_layers(count, duration)
+
+        clips = [character_clip(character, states, position, resolution, fps, duration)
+                 for character, states, position in layers]
+        reference = mp.CompositeVideoClip(clips, size=resolution, bg_color=(0, 0, 0)).set_duration(duration)
+
+        sprites = [SpriteLayer(character, states, position, resolution, fps, duration)
+                   for character, states, position in layers]
+        layered = LayeredCompositeClip(sprites, resolution, duration)
+
+        before = time_frames(reference, args.frames)
+        after = time_frames(layered, args.frames)
+        print(f"{count:>10} {before * 1000:>17.1f} ms {after * 1000:>11.1f} ms {before / after:>7.1f}x")
+
+if __name__ == '__main__':
+    sys.exit(main())
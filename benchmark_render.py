@@ -0,0 +1,63 @@
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+
+from animation_core import resolution, fps, state_runs, SegmentRenderer
+
+# 最終動画レンダリングの並列化ベンチマーク
+#   タイムラインを N 個のチャンクに分けてプロセスプールでエンコードし、1 チャンク（単一プロセス）との速度比を出す
+#   音声のミックスと連結は並列化の対象外なので計測しない
+#
+#   python benchmark_render.py --seconds 60 --workers 1 2 4 8
+
+characters = ['ずんだもん', '四国めたん']
+positions = ['left_10', 'left_25', 'center', 'right_25', 'right_10']
+
+def make_specs(count, duration, line_seconds=8, seed=0):
+    rng = np.random.default_rng(seed)
+    frame_count = int(line_seconds * fps)
+    specs = []
+    for i in range(count):
+        for start in np.arange(i * 2.0, duration, line_seconds + 2):
+            states = rng.integers(0, 6, frame_count).astype(np.uint8)
+            data = {
+                "character": characters[i % len(characters)],
+                "position": positions[i % len(positions)],
+                "sprite_timeline": state_runs(states),
+                "fps": fps,
+                "duration": line_seconds,
+            }
+            specs.append({"layer": i + 1, "start": float(start), "duration": line_seconds, "data": data})
+    return specs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="最終動画レンダリングの並列化ベンチマーク")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--characters", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--preset", default="medium")
+    args = parser.parse_args(argv)
+
+    specs = make_specs(args.characters, args.seconds)
+    print(f"{resolution[0]}x{resolution[1]}, {args.seconds:g} s, {len(specs)} lines, preset {args.preset}")
+    print(f"{'chunks':>6} {'time':>9} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        cache_dir = tempfile.mkdtemp(prefix="segments_")
+        try:
+            renderer = SegmentRenderer(resolution, fps, preset=args.preset, cache_dir=cache_dir, temp_dir=cache_dir)
+            segments = [(first, last, str(i)) for i, (first, last) in enumerate(renderer.segments(args.seconds))]
+            started = time.perf_counter()
+            renderer.render_segments(specs, args.seconds, segments, workers=workers, chunks=workers)
+            elapsed = time.perf_counter() - started
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        baseline = baseline or elapsed
+        print(f"{workers:>6} {elapsed:>7.1f} s {baseline / elapsed:>7.1f}x")
+
+if __name__ == '__main__':
+    sys.exit(main())
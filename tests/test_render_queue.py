@@ -0,0 +1,116 @@
+# ProjectIndex の採番と RenderQueue の状態遷移（SQLite のみ、wx・ffmpeg は不要）
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from animation_core import ProjectIndex, RenderQueue
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # allocate_number はカレントの video/ も見るので一時ディレクトリへ移動
+    monkeypatch.chdir(tmp_path)
+    return ProjectIndex(path=str(tmp_path / "project.db"), json_dir=str(tmp_path / "json"))
+
+
+def allocate_many(path, count):
+    index = ProjectIndex(path=path, json_dir="json")
+    return [index.allocate_number() for _ in range(count)]
+
+
+def status(queue, job_id):
+    return queue.index.connect().execute("SELECT status, cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_allocate_number_unique_across_processes(index):
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(allocate_many, [index.path] * 8, [25] * 8))
+    numbers = [number for result in results for number in result]
+    assert sorted(numbers) == list(range(1, 201))
+    # 各プロセス内では単調増加
+    assert all(result == sorted(result) for result in results)
+
+
+def test_allocate_number_continues_after_existing_files(index, tmp_path):
+    (tmp_path / "video").mkdir()
+    (tmp_path / "video" / "output_7.mov").touch()
+    assert index.allocate_number() == 8
+    assert index.allocate_number() == 9
+    # 削除された番号は再利用しない
+    (tmp_path / "video" / "output_7.mov").unlink()
+    assert ProjectIndex(path=index.path).allocate_number() == 10
+
+
+def test_claim_order_and_finish(index):
+    queue = RenderQueue(index)
+    low = queue.submit("generate", {"text": "a"})
+    high = queue.submit("compose", {"output": "b.mp4"}, priority=5)
+    low2 = queue.submit("generate", {"text": "c"})
+
+    job = queue.claim()
+    assert job["id"] == high and job["kind"] == "compose" and job["params"] == {"output": "b.mp4"}
+    assert status(queue, high) == ("running", 0)
+    assert [queue.claim()["id"], queue.claim()["id"]] == [low, low2]
+    assert queue.claim() is None
+
+    queue.finish(high, "done")
+    assert [row[0] for row in queue.jobs()] == [low, low2]
+    assert [row[0] for row in queue.jobs(("done",))] == [high]
+
+
+def test_cancel_queued_and_running(index):
+    queue = RenderQueue(index)
+    running = queue.submit("generate", {})
+    waiting = queue.submit("generate", {})
+    assert queue.claim()["id"] == running
+
+    queue.cancel()
+    # 待機中はその場で取り消し、実行中は要求フラグだけ立つ
+    assert status(queue, waiting) == ("cancelled", 0)
+    assert status(queue, running) == ("running", 1)
+    assert queue.cancel_requested(running)
+    assert not queue.cancel_requested(waiting)
+    assert queue.claim() is None
+
+    queue.finish(running, "cancelled")
+    assert queue.jobs() == []
+
+
+def test_cancel_single_job(index):
+    queue = RenderQueue(index)
+    first = queue.submit("generate", {})
+    second = queue.submit("generate", {})
+    queue.cancel(first)
+    assert status(queue, first) == ("cancelled", 0)
+    assert status(queue, second) == ("queued", 0)
+    assert queue.claim()["id"] == second
+
+
+def test_resume_requeues_crashed_jobs(index):
+    queue = RenderQueue(index)
+    job_id = queue.submit("compose", {"output": "a.mp4"})
+    queue.claim()
+    queue.save_checkpoint(job_id, {"segments": 3})
+
+    # 強制終了後の再起動（別インスタンス・新しい接続）
+    restarted = RenderQueue(ProjectIndex(path=index.path))
+    assert restarted.resume() == 1
+    assert status(restarted, job_id) == ("queued", 0)
+    job = restarted.claim()
+    assert job["id"] == job_id and job["checkpoint"] == {"segments": 3}
+
+
+def test_resume_cancels_job_that_crashed_while_cancelling(index):
+    queue = RenderQueue(index)
+    cancelled = queue.submit("compose", {})
+    crashed = queue.submit("generate", {})
+    queue.claim()
+    queue.claim()
+    queue.cancel(cancelled)
+
+    restarted = RenderQueue(ProjectIndex(path=index.path))
+    assert restarted.resume() == 1
+    assert status(restarted, cancelled) == ("cancelled", 1)
+    assert status(restarted, crashed) == ("queued", 0)
+    assert restarted.claim()["id"] == crashed
+    assert restarted.claim() is None